@@ -1,13 +1,9 @@
-import os
 import json
 import re
-from pymongo import MongoClient
 from datetime import datetime
-from core import call_llm, serializar_mongo
+from core import call_llm, serializar_mongo, db
 from langchain.prompts import PromptTemplate
 
-client = MongoClient(os.environ["MONGO_URI"])
-db = client["financebot"]
 transactions = db["transactions"]
 data_atual = datetime.now().strftime('%Y-%m-%d')
 model_llm = "gpt-4o"
@@ -23,9 +19,8 @@ def listar_indices_mongo():
 
 indices = listar_indices_mongo()
 
-prompt_pipeline_llm = PromptTemplate(
-    input_variables=["data_atual", "indices", "pergunta_usuario"],
-    template="""
+# Regras de montagem de pipeline compartilhadas pela consulta simples e pela análise em lote
+instrucoes_pipeline = """
 Considere que a data atual é {data_atual}
 Você é um agente financeiro especialista em MongoDB. Sua tarefa é, dado uma pergunta sobre a coleção "transactions" ou "categories", montar uma pipeline válida para consulta no MongoDB via pymongo. Siga sempre as instruções abaixo:
 
@@ -62,7 +57,11 @@ Você é um agente financeiro especialista em MongoDB. Sua tarefa é, dado uma p
 - Para reportar ao usuário, quando estiver mencionando apenas despesas, retorne valores absolutos.
 - Quando o usuário perguntar por maiores e top de categorias ou estabelecimentos, caso não especifique se é receita, considere que é sobre despesas. 
 - Não use campos que não existem.
-- Nunca explique, apenas retorne um json no seguinte formado:
+"""
+
+prompt_pipeline_llm = PromptTemplate(
+    input_variables=["data_atual", "indices", "pergunta_usuario"],
+    template=instrucoes_pipeline + """- Nunca explique, apenas retorne um json no seguinte formado:
 {{
  "collection":"NomeDaCollection",
  "pipeline":[...]
@@ -72,6 +71,22 @@ Pergunta do usuário: {pergunta_usuario}
 """
 )
 
+prompt_pipelines_lote_llm = PromptTemplate(
+    input_variables=["data_atual", "indices", "pergunta_usuario"],
+    template=instrucoes_pipeline + """- A pergunta pode conter várias perguntas independentes (ex: "saldo de maio, top 5 categorias e gasto no ifood"). Separe-a em sub-perguntas e monte uma pipeline para cada uma.
+- Quando sub-perguntas tratarem do mesmo período, use exatamente o mesmo filtro de "data" no $match de cada uma.
+- Nunca explique, apenas retorne um json no seguinte formado:
+{{
+ "consultas":[
+   {{"pergunta":"sub-pergunta 1", "collection":"NomeDaCollection", "pipeline":[...]}},
+   {{"pergunta":"sub-pergunta 2", "collection":"NomeDaCollection", "pipeline":[...]}}
+ ]
+}}
+
+Pergunta do usuário: {pergunta_usuario}
+"""
+)
+
 prompt_interpretar_resultado = PromptTemplate(
     input_variables=["data_atual", "pergunta", "resultado"],
     template="""
@@ -121,6 +136,29 @@ def montar_pipeline_llm(pergunta_usuario: str):
     print(f"Pipeline gerada: {match.group(1)}")
     return match.group(1)
 
+def montar_pipelines_lote_llm(pergunta_usuario: str) -> list[dict]:
+    """Separa a pergunta em sub-perguntas e gera a pipeline de cada uma em uma única chamada ao LLM."""
+    prompt = prompt_pipelines_lote_llm.format(
+        data_atual=data_atual,
+        indices=indices,
+        pergunta_usuario=pergunta_usuario
+    )
+
+    response = call_llm(model_llm, 0, prompt)
+
+    match = re.search(r"\{.*\}", response, re.DOTALL)
+    try:
+        consultas = json.loads(match.group(0))["consultas"]
+    except Exception:
+        raise Exception(f"A LLM não retornou um JSON válido com as consultas. Retorno: {response}")
+    if not isinstance(consultas, list) or not consultas or not all(
+        isinstance(c, dict) and "collection" in c and "pipeline" in c for c in consultas
+    ):
+        raise Exception(f"A LLM não retornou collection e pipeline para todas as consultas. Retorno: {response}")
+
+    print(f"Pipelines geradas: {consultas}")
+    return consultas
+
 def ajustar_datas_no_pipeline(pipeline):
     for etapa in pipeline:
         if "$match" in etapa and "data" in etapa["$match"]:
@@ -148,16 +186,74 @@ def validar_pipeline(pipeline):
         return False, "$limit só pode ser a última etapa."
     return True, None
 
-def executar_pipeline(pipeline, collection):
+def agrupar_em_facet(consultas):
+    """
+    Junta as consultas da mesma collection com o mesmo filtro de data em uma única pipeline:
+    um $match pelo período seguido de um $facet com o restante de cada consulta.
+    Retorna lista de (collection, pipeline, índices das consultas atendidas por ela).
+    """
+    grupos = {}
+    for i, consulta in enumerate(consultas):
+        pipeline = consulta["pipeline"]
+        filtro_data = None
+        if pipeline and "$match" in pipeline[0] and "data" in pipeline[0]["$match"]:
+            filtro_data = pipeline[0]["$match"]["data"]
+        # Forma canônica: a ordem dos operadores ($gte/$lt...) não separa consultas do mesmo período
+        chave = (consulta["collection"], json.dumps(filtro_data, sort_keys=True, default=str))
+        grupos.setdefault(chave, {"collection": consulta["collection"], "data": filtro_data, "indices": []})
+        grupos[chave]["indices"].append(i)
+
+    execucoes = []
+    for grupo in grupos.values():
+        if len(grupo["indices"]) == 1:
+            i = grupo["indices"][0]
+            execucoes.append((grupo["collection"], consultas[i]["pipeline"], grupo["indices"]))
+            continue
+
+        facetas = {}
+        for i in grupo["indices"]:
+            etapas = list(consultas[i]["pipeline"])
+            if etapas and "$match" in etapas[0]:
+                # O filtro de data já é aplicado antes do $facet; mantém só o restante do $match
+                resto_match = {k: v for k, v in etapas[0]["$match"].items() if k != "data"}
+                etapas = ([{"$match": resto_match}] if resto_match else []) + etapas[1:]
+            facetas[f"consulta_{i}"] = etapas or [{"$match": {}}]
+
+        pipeline = [{"$facet": facetas}]
+        if grupo["data"] is not None:
+            pipeline.insert(0, {"$match": {"data": grupo["data"]}})
+        execucoes.append((grupo["collection"], pipeline, grupo["indices"]))
+    return execucoes
+
+def executar_pipeline(pipeline, collection, facet=False):
+    # facet=True: pipeline montada por agrupar_em_facet, o resultado é um dict {faceta: documentos}
     try:       
         resultado = list(db[collection].aggregate(pipeline))
         print(f"Resultado pipeline: {resultado}")
+        if facet:
+            facetas = resultado[0] if resultado else {}
+            resultado_serializado = {nome: [serializar_mongo(doc.copy()) for doc in docs] for nome, docs in facetas.items()}
+            print(f"Resultado pipeline serializado: {resultado_serializado}")
+            return resultado_serializado
         resultado_serializado = [serializar_mongo(doc.copy()) for doc in resultado]
         print(f"Resultado pipeline serializado: {resultado_serializado}")
         return resultado_serializado
     except Exception as e:
         raise Exception(f"Falha na execução de pipeline no mongoDb. Collection: {collection} | Pipeline: {pipeline}. Mensagem de erro: {e}")
 
+def executar_consultas_em_lote(consultas):
+    """Executa as consultas agrupadas em $facet e devolve o resultado de cada uma, na ordem original."""
+    resultados = [None] * len(consultas)
+    for collection, pipeline, indices_consultas in agrupar_em_facet(consultas):
+        facet = len(indices_consultas) > 1
+        resultado = executar_pipeline(pipeline, collection, facet=facet)
+        if not facet:
+            resultados[indices_consultas[0]] = resultado
+        else:
+            for i in indices_consultas:
+                resultados[i] = resultado.get(f"consulta_{i}", [])
+    return resultados
+
 def agente_interpretar_resultado_mongo(pergunta, resultado):
     prompt = prompt_interpretar_resultado.format(
         data_atual=data_atual,
@@ -1,16 +1,24 @@
 from langchain.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 from datetime import datetime, timedelta
-from pymongo import MongoClient
+from modelo_categoria import ModeloCategoria, confianca_minima
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import threading
+import unicodedata
 import hashlib
 import json
 import os
+import re
 
 mongo_client = MongoClient(os.environ["MONGO_URI"])
 db = mongo_client["financebot"]
 db_transactions = db["transactions"]
 db_categories = db["categories"]
 
+# Modelo local de categorias, lendo o histórico pelo mesmo client do core
+modelo_categoria = ModeloCategoria(db_transactions)
+
 model_llm = "gpt-4.1-mini"
 
 
@@ -37,22 +45,214 @@ def validate_request(requestDescription, response):
         raise Exception(f"Erro no request {requestDescription}. Status {response.status_code}, Message: {response.text}")
 
 def serializar_mongo(doc):
-    doc["_id"] = str(doc["_id"])
+    if "_id" in doc:
+        doc["_id"] = str(doc["_id"])
     if isinstance(doc.get("data"), datetime):
         doc["data"] = doc["data"].strftime("%Y-%m-%d")
     return doc
 
-def buscar_categoria_por_transacoes(estabelecimento: str, dias: int = 30) -> str | None:
+# Sufixos societários e de adquirente que não identificam o estabelecimento
+_sufixos_estabelecimento = {"ltda", "me", "mei", "epp", "eireli", "sa", "s/a", "cia", "com", "br"}
+
+def normalizar_estabelecimento(estabelecimento: str) -> str:
+    """
+    Gera a chave canônica do estabelecimento: sem acentos, sem pontuação,
+    sem sufixos (ex: "*SP", "LTDA") e sem espaços.
+    Ex: "iFood", "i food" e "IFOOD*SP" viram "ifood".
+    """
+    texto = unicodedata.normalize("NFKD", estabelecimento or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    # Adquirentes usam "*" para separar o estabelecimento do complemento (cidade, pedido...)
+    texto = texto.split("*", 1)[0]
+    palavras = re.sub(r"[^a-z0-9/ ]+", " ", texto).split()
+    while len(palavras) > 1 and palavras[-1] in _sufixos_estabelecimento:
+        palavras.pop()
+    return re.sub(r"[^a-z0-9]+", "", "".join(palavras))
+
+def _trigramas(chave: str) -> set[str]:
+    chave = f"  {chave} "
+    return {chave[i:i + 3] for i in range(len(chave) - 2)}
+
+# Origens de categoria usadas como referência no índice de similaridade
+origens_ancora = ["usuario", "llm", "historico"]
+
+class IndiceTrigramas:
+    """
+    Índice local de similaridade por trigramas entre chaves de estabelecimentos
+    já categorizados. Carregado do MongoDB no primeiro uso e atualizado a cada inserção.
+    """
+
+    def __init__(self, similaridade_minima: float = 0.55):
+        self.similaridade_minima = similaridade_minima
+        self._categorias = {}   # chave -> categoria
+        self._n_trigramas = {}  # chave -> quantidade de trigramas
+        self._postings = {}     # trigrama -> set(chaves)
+        self._carregado = False
+        self._lock = threading.Lock()
+
+    def _carregar(self):
+        pipeline = [
+            {"$match": {
+                "estabelecimento_chave": {"$exists": True},
+                "categoria": {"$ne": None},
+                "$or": [
+                    {"categoria_origem": {"$in": origens_ancora}},
+                    {"categoria_origem": {"$exists": False}}
+                ]
+            }},
+            {"$sort": {"data": 1}},
+            {"$group": {"_id": "$estabelecimento_chave", "categoria": {"$last": "$categoria"}}}
+        ]
+        for doc in db_transactions.aggregate(pipeline):
+            self._adicionar(doc["_id"], doc["categoria"])
+        self._carregado = True
+        print(f"Índice de estabelecimentos carregado: {len(self._categorias)} chaves")
+
+    def _adicionar(self, chave: str, categoria: str):
+        if not chave or not categoria:
+            return
+        if chave not in self._categorias:
+            trigramas = _trigramas(chave)
+            for trigrama in trigramas:
+                self._postings.setdefault(trigrama, set()).add(chave)
+            self._n_trigramas[chave] = len(trigramas)
+        self._categorias[chave] = categoria
+
+    def adicionar(self, chave: str, categoria: str, origem: str | None = None):
+        # Categorias vindas do próprio índice ou do modelo não viram âncora, para não encadear palpites
+        if origem not in origens_ancora:
+            return
+        with self._lock:
+            if self._carregado:
+                self._adicionar(chave, categoria)
+
+    def buscar(self, chave: str) -> tuple[str, float] | None:
+        """Retorna (categoria, similaridade) do estabelecimento mais parecido, se acima do limiar."""
+        if not chave:
+            return None
+        with self._lock:
+            if not self._carregado:
+                try:
+                    self._carregar()
+                except Exception as e:
+                    # Sem índice a busca segue para o modelo/LLM; tenta carregar de novo na próxima chamada
+                    print(f"Falha ao carregar índice de estabelecimentos: {e}")
+                    self._categorias, self._n_trigramas, self._postings = {}, {}, {}
+                    return None
+            if chave in self._categorias:
+                return self._categorias[chave], 1.0
+            trigramas = _trigramas(chave)
+            comuns = {}
+            for trigrama in trigramas:
+                for candidata in self._postings.get(trigrama, ()):
+                    comuns[candidata] = comuns.get(candidata, 0) + 1
+            melhor, melhor_score = None, 0.0
+            for candidata, n in comuns.items():
+                score = n / (len(trigramas) + self._n_trigramas[candidata] - n)
+                if score > melhor_score:
+                    melhor, melhor_score = candidata, score
+            if melhor is None or melhor_score < self.similaridade_minima:
+                return None
+            return self._categorias[melhor], melhor_score
+
+indice_estabelecimentos = IndiceTrigramas()
+
+def buscar_categoria_por_transacoes(estabelecimento: str, dias: int = 30) -> tuple[str, str] | None:
+    """Retorna (categoria, origem), com origem "historico" (mesmo estabelecimento) ou "similaridade" (trigramas)."""
+    chave = normalizar_estabelecimento(estabelecimento)
     data_limite = datetime.now() - timedelta(days=dias)
     resultado = db_transactions.find_one(
-        {"estabelecimento": estabelecimento.lower(), "data": {"$gte": data_limite}},
+        {"estabelecimento_chave": chave, "data": {"$gte": data_limite}, "categoria": {"$ne": None}},
         sort=[("data", -1)]
     )
-    return resultado.get("categoria") if resultado else None
+    if resultado:
+        return resultado.get("categoria"), "historico"
+
+    similar = indice_estabelecimentos.buscar(chave)
+    if similar:
+        categoria, score = similar
+        print(f"Estabelecimento '{chave}' associado por similaridade ({score:.2f}) à categoria {categoria}")
+        return categoria, "similaridade"
+    return None
 
 def buscar_categorias_existentes():
     return list(db_categories.find({}, {"_id": 0, "nome": 1, "descricao": 1}))
 
+def normalizar_categoria(nome: str) -> str:
+    """Chave da categoria: sem acentos, minúscula e com espaços colapsados. Ex: "Alimentação " vira "alimentacao"."""
+    texto = unicodedata.normalize("NFKD", nome or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    return " ".join(texto.split())
+
+def buscar_categoria_por_nome(nome: str) -> dict | None:
+    return db_categories.find_one({"nome_chave": normalizar_categoria(nome)})
+
+def upsert_categoria(nome: str, descricao: str) -> str:
+    """
+    Cria a categoria de forma atômica (apoiada no índice único em 'nome_chave').
+    Retorna o nome gravado no banco, que pode ser o de uma categoria equivalente já existente.
+    """
+    chave = normalizar_categoria(nome)
+    try:
+        categoria = db_categories.find_one_and_update(
+            {"nome_chave": chave},
+            {"$setOnInsert": {"nome": nome, "nome_chave": chave, "descricao": descricao}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Outro processo criou a mesma categoria entre o find e o insert do upsert
+        categoria = db_categories.find_one({"nome_chave": chave})
+    return categoria["nome"]
+
+def backfill_nome_chave_categorias() -> int:
+    """Preenche 'nome_chave' nas categorias antigas. Execução única (idempotente), chamada pelo setup_mongodb.py."""
+    operacoes = [
+        UpdateOne({"_id": doc["_id"]}, {"$set": {"nome_chave": normalizar_categoria(doc.get("nome", ""))}})
+        for doc in db_categories.find({"nome_chave": {"$exists": False}}, {"nome": 1})
+    ]
+    if not operacoes:
+        return 0
+    return db_categories.bulk_write(operacoes, ordered=False).modified_count
+
+class SingleFlight:
+    """
+    Coalescência de chamadas concorrentes no mesmo processo: para uma mesma chave,
+    apenas a primeira chamada executa a função; as demais aguardam e recebem o mesmo resultado.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._em_andamento = {}  # chave -> [Event, resultado, erro]
+
+    def executar(self, chave, funcao, *args, **kwargs):
+        with self._lock:
+            chamada = self._em_andamento.get(chave)
+            lider = chamada is None
+            if lider:
+                chamada = [threading.Event(), None, None]
+                self._em_andamento[chave] = chamada
+
+        if not lider:
+            print(f"Aguardando chamada em andamento para {chave}")
+            chamada[0].wait()
+            if chamada[2] is not None:
+                raise chamada[2]
+            return chamada[1]
+
+        try:
+            chamada[1] = funcao(*args, **kwargs)
+            return chamada[1]
+        except Exception as e:
+            chamada[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._em_andamento[chave]
+            chamada[0].set()
+
+single_flight = SingleFlight()
+
 
 def resumir_prompt(prompt_text, n=400):
     head = prompt_text.strip().replace("\n", " ")[:n]
@@ -92,8 +292,31 @@ def call_llm(model: str, temperature: float, user_prompt: str, system_role: str
 
 def insert_transaction_to_mongo(transaction: dict) -> None:
     transaction["estabelecimento"] = transaction["estabelecimento"].lower()
+    transaction["estabelecimento_chave"] = normalizar_estabelecimento(transaction["estabelecimento"])
     transaction["data"] = datetime.strptime(transaction["data"], "%Y-%m-%d")
     db_transactions.insert_one(transaction)
+    indice_estabelecimentos.adicionar(
+        transaction["estabelecimento_chave"], transaction.get("categoria"), transaction.get("categoria_origem")
+    )
+    modelo_categoria.registrar_transacao()
+
+def backfill_estabelecimento_chave(batch_size: int = 1000) -> int:
+    """
+    Preenche 'estabelecimento_chave' nas transações antigas que ainda não a possuem.
+    Execução única (idempotente), chamada pelo setup_mongodb.py.
+    """
+    total = 0
+    operacoes = []
+    cursor = db_transactions.find({"estabelecimento_chave": {"$exists": False}}, {"estabelecimento": 1})
+    for doc in cursor:
+        chave = normalizar_estabelecimento(doc.get("estabelecimento", ""))
+        operacoes.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"estabelecimento_chave": chave}}))
+        if len(operacoes) >= batch_size:
+            total += db_transactions.bulk_write(operacoes, ordered=False).modified_count
+            operacoes = []
+    if operacoes:
+        total += db_transactions.bulk_write(operacoes, ordered=False).modified_count
+    return total
 
 def get_existing_category_by_llm(user_message: str, categorias_existentes: list[str]) -> dict:
     user_prompt = f"""Mensagem do usuario: {user_message}\nCategorias existentes:\n"""
@@ -135,6 +358,39 @@ def create_new_category_by_llm(user_message: str) -> dict:
     response = call_llm(model_llm, 0, prompt, system_role)
     return json.loads(response)
 
+def garantir_categoria(categoria: str, estabelecimento: str) -> str:
+    """Garante que a categoria existe e retorna o nome com que ela está gravada."""
+    categoryExists = buscar_categoria_por_nome(categoria)
+    if not categoryExists:
+        print("Categoria não existe, vou pensar em uma descrição")
+        user_prompt = f"Crie uma descrição curta para a categoria '{categoria}'. O nome do estabelecimento é '{estabelecimento}', mas só leve em consideração caso seja significativo."
+        system_role = "Você gera descrições curtas para categorias de gastos pessoais."
+        description = call_llm(model_llm, 0, user_prompt, system_role)
+        print("Inserindo categoria no db")
+        return upsert_categoria(categoria, description)
+    print(f"categoria já existe {categoryExists['nome']}")
+    return categoryExists["nome"]
+
+def categorizar_estabelecimento_por_llm(estabelecimento: str) -> str | None:
+    print(f"categoria não encontrada, vou tentar reconhecer nas categorias existentes")            
+    categorias_existentes = buscar_categorias_existentes()
+    result = get_existing_category_by_llm(estabelecimento, categorias_existentes)
+    if result["foundCategory"]:
+        # Usa o nome gravado no banco, não a grafia devolvida pelo LLM
+        existente = buscar_categoria_por_nome(result["categoryName"] or "")
+        if existente:
+            print(f"categoria encontrada: {existente['nome']}")
+            return existente["nome"]
+        print(f"LLM indicou categoria inexistente: {result['categoryName']}")
+
+    print(f"categoria não encontrada, vou tentar criar uma nova")
+    nova_categoria = create_new_category_by_llm(estabelecimento)
+    if not nova_categoria["addCategory"]:
+        return None
+    categoria = nova_categoria["categoryName"]
+    print(f"Criando nova categoria: {categoria} - {nova_categoria['categoryDescription']}")
+    return upsert_categoria(categoria, nova_categoria["categoryDescription"])
+
 def interpretar_mensagem_llm(texto):
     system_role = """Você é um assistente do controle financeiro e deve interpretar as mensagens do usuário.
                     As mensagens representam receitas ou despesas pessoais e podem conter valor, categoria, data e descrição.
@@ -162,49 +418,36 @@ def interpretar_mensagem_llm(texto):
     dados = json.loads(response)
 
     categoria = None
+    # Origem da categoria: só "usuario" e "llm" são usadas para treinar o modelo local
+    origem = None
 
     if "categoria" in texto.lower():
         print("Mensagem contem 'categoria'")
         categoria = dados.get("categoria")
         estabelecimento = dados["estabelecimento"].lower()
-        categoryExists = db_categories.find_one({"nome": categoria})
-        if not categoryExists:
-            print("Categoria não existe, vou pensar em uma descrição")
-            user_prompt = f"Crie uma descrição curta para a categoria '{categoria}'. O nome do estabelecimento é '{estabelecimento}', mas só leve em consideração caso seja significativo."
-            system_role = "Você gera descrições curtas para categorias de gastos pessoais."
-            description = call_llm(model_llm, 0, user_prompt, system_role)
-            print("Inserindo categoria no db")
-            db_categories.insert_one({
-                "nome": categoria,
-                "descricao": description
-            })
-        else:
-            print(f"categoria já existe {categoria}")
+        if categoria:
+            # Mesma chave do upsert: chamadas com "Alimentação" e "alimentação" resolvem para a mesma categoria
+            chave = ("categoria", normalizar_categoria(categoria))
+            categoria = single_flight.executar(chave, garantir_categoria, categoria, estabelecimento)
+            origem = "usuario"
     else:
         print("Buscando categoria em outras transacoes")
-        categoria = buscar_categoria_por_transacoes(dados["estabelecimento"])
+        encontrada = buscar_categoria_por_transacoes(dados["estabelecimento"])
+        if encontrada:
+            categoria, origem = encontrada
+        else:
+            previsao = modelo_categoria.prever(dados["estabelecimento"])
+            if previsao and previsao[1] >= confianca_minima:
+                categoria, origem = previsao[0], "modelo"
+                print(f"categoria prevista pelo modelo local: {categoria} (confiança {previsao[1]:.2f})")
         if categoria:
             print(f"categoria encontrada: {categoria}")            
         else:
-            print(f"categoria não encontrada, vou tentar reconhecer nas categorias existentes")            
-            categoria = None
-            categorias_existentes = buscar_categorias_existentes()
-            result = get_existing_category_by_llm(dados["estabelecimento"], categorias_existentes)
-            if result["foundCategory"]:
-                print(f"categoria encontrada: {result['categoryName']}")
-                categoria = result["categoryName"]
-            else:
-                print(f"categoria não encontrada, vou tentar criar uma nova")
-                nova_categoria = create_new_category_by_llm(dados["estabelecimento"])
-                if nova_categoria["addCategory"]:
-                    print(f"criando categoria: {nova_categoria['categoryName']}")
-                    categoria = nova_categoria["categoryName"]
-                    print(f"Criando nova categoria: {categoria} - {nova_categoria['categoryDescription']}")
-                    db_categories.insert_one({
-                        "nome": categoria,
-                        "descricao": nova_categoria["categoryDescription"]
-                    })
+            chave = ("estabelecimento", normalizar_estabelecimento(dados["estabelecimento"]))
+            categoria = single_flight.executar(chave, categorizar_estabelecimento_por_llm, dados["estabelecimento"])
+            origem = "llm" if categoria else None
     dados["categoria"] = categoria
+    dados["categoria_origem"] = origem
     return dados
 
 def formatar_valor_brl(valor):
@@ -2,13 +2,12 @@ from core import (
     interpretar_mensagem_llm, 
     insert_transaction_to_mongo, 
     formatar_valor_brl,
-    call_llm
+    call_llm,
+    db
 )
 from datetime import datetime
-import os
-from agent_data_analisys import montar_pipeline_llm, validar_pipeline, ajustar_datas_no_pipeline, executar_pipeline, agente_interpretar_resultado_mongo
+from agent_data_analisys import montar_pipeline_llm, montar_pipelines_lote_llm, validar_pipeline, ajustar_datas_no_pipeline, executar_pipeline, executar_consultas_em_lote, agente_interpretar_resultado_mongo
 import json
-from pymongo import MongoClient
 from agent_grafico import agente_gerar_grafico, avaliar_necessidade_grafico
 from langchain.prompts import PromptTemplate
 
@@ -19,15 +18,17 @@ prompt_rotear_intencao = PromptTemplate(
     input_variables=["texto"],
     template="""
 Você é um assistente financeiro.
-Sua tarefa é analisar a mensagem do usuário e indicar, com base apenas no conteúdo, qual é a intenção principal da mensagem. Escolha APENAS uma das três opções abaixo e responda SOMENTE com o valor correspondente:
+Sua tarefa é analisar a mensagem do usuário e indicar, com base apenas no conteúdo, qual é a intenção principal da mensagem. Escolha APENAS uma das opções abaixo e responda SOMENTE com o valor correspondente:
 
 - "analise": se o usuário está perguntando ou solicitando análise de dados financeiros (por exemplo: consultas, perguntas, pedidos de relatório ou resumo de informações, perguntas com '?').
+- "analise_lote": se o usuário faz várias perguntas de análise diferentes na mesma mensagem (ex: resumo com saldo, top categorias e gasto em um estabelecimento).
 - "insercao": se o usuário está enviando uma nova transação financeira (despesa, receita, valor gasto ou recebido, lançamento de registro, frase contendo valor numérico a ser anotado).
 - "reportar_erro": se o usuário está reportando algum erro, falha ou comportamento inesperado.
 - "desconhecido": se a mensagem não se encaixar em nenhuma das opções anteriores.
 
 Exemplos:
 - "Quais foram meus gastos este mês?" -> analise
+- "Saldo de maio, top 5 categorias e gasto no ifood" -> analise_lote
 - "Recebi 100 reais da Ana" -> insercao
 - "20 abc" - > insercao
 - "Nesse caso deveria ter reconhecido que era uma transação" -> erro
@@ -37,7 +38,7 @@ Exemplos:
 Mensagem do usuário:
 "{texto}"
 
-Responda apenas com uma das opções: analise, insercao, reportar_erro, desconhecido.
+Responda apenas com uma das opções: analise, analise_lote, insercao, reportar_erro, desconhecido.
 """
 )
 
@@ -58,7 +59,7 @@ def rotear_intencao_usuario(texto: str):
     prompt = prompt_rotear_intencao.format(texto=texto)
     response = call_llm(model_llm, 0, prompt)
     # Garante que só retorna os valores esperados
-    if response in {"analise", "insercao", "reportar_erro", "desconhecido"}:
+    if response in {"analise", "analise_lote", "insercao", "reportar_erro", "desconhecido"}:
         return response
     return "desconhecido"
 
@@ -99,6 +100,35 @@ def agente_consulta_dados(pergunta_usuario: str):
         "grafico": figure_dict
     }
 
+def agente_consulta_dados_lote(pergunta_usuario: str):
+    """
+    Análise de perguntas compostas: gera as pipelines de todas as sub-perguntas em uma chamada,
+    executa as que compartilham o período em um único $facet e interpreta tudo em uma só resposta.
+    """
+    consultas = montar_pipelines_lote_llm(pergunta_usuario)
+    for consulta in consultas:
+        isValid, err = validar_pipeline(consulta["pipeline"])
+        if not isValid:
+            raise Exception(f"{err} Sub-pergunta: {consulta.get('pergunta')}")
+        consulta["pipeline"] = ajustar_datas_no_pipeline(consulta["pipeline"])
+
+    resultados = executar_consultas_em_lote(consultas)
+    resultado = [
+        {"pergunta": consulta.get("pergunta"), "resultado": res}
+        for consulta, res in zip(consultas, resultados)
+    ]
+    resposta = agente_interpretar_resultado_mongo(pergunta_usuario, resultado)
+
+    if avaliar_necessidade_grafico(pergunta_usuario, resultado):
+        figure_dict = agente_gerar_grafico(pergunta_usuario, resultado)
+    else:
+        figure_dict = None
+
+    return {
+        "mensagem": resposta,
+        "grafico": figure_dict
+    }
+
 def registrar_erro_mongo(mensagem: str, reportedBy: str):
     """
     Interpreta a mensagem de erro via LLM, gera um resumo estruturado e salva na collection 'errors'.
@@ -130,9 +160,7 @@ def registrar_erro_mongo(mensagem: str, reportedBy: str):
         "status": "New"
     }
 
-    # Salva no MongoDB (collection 'errors')
-    client = MongoClient(os.environ["MONGO_URI"])
-    db = client["financebot"]
+    # Salva no MongoDB (collection 'errors'), reaproveitando o client compartilhado do core
     db["errors"].insert_one(doc)
     
     return doc
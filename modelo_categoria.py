@@ -0,0 +1,169 @@
+import os
+import threading
+from datetime import datetime
+import joblib
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import GroupShuffleSplit
+from sklearn.pipeline import make_pipeline
+
+caminho_modelo = os.environ.get("MODELO_CATEGORIA_PATH", os.path.join("models", "modelo_categoria.joblib"))
+confianca_minima = 0.7
+retreino_a_cada = 50  # novas transações até disparar o retreino em background
+
+
+def carregar_historico(transactions):
+    """
+    Retorna (estabelecimentos, categorias) das transações categorizadas pelo usuário ou pelo LLM.
+    Categorias reaproveitadas do histórico, por similaridade ou pelo próprio modelo ficam de fora
+    para não realimentar o treino com as próprias previsões. Transações anteriores ao campo
+    'categoria_origem' são consideradas rótulos aceitos.
+    """
+    cursor = transactions.find(
+        {
+            "estabelecimento": {"$type": "string"},
+            "categoria": {"$type": "string"},
+            "$or": [
+                {"categoria_origem": {"$in": ["usuario", "llm"]}},
+                {"categoria_origem": {"$exists": False}}
+            ]
+        },
+        {"_id": 0, "estabelecimento": 1, "categoria": 1}
+    )
+    estabelecimentos, categorias = [], []
+    for doc in cursor:
+        estabelecimentos.append(doc["estabelecimento"].lower())
+        categorias.append(doc["categoria"])
+    return estabelecimentos, categorias
+
+
+def criar_pipeline():
+    return make_pipeline(
+        TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4), sublinear_tf=True),
+        LogisticRegression(max_iter=1000, class_weight="balanced")
+    )
+
+
+def avaliar_holdout(estabelecimentos, categorias, proporcao_teste=0.2):
+    """
+    Acurácia offline em estabelecimentos nunca vistos no treino.
+    A separação é feita por estabelecimento para não repetir o mesmo nome em treino e teste.
+    """
+    if len(set(estabelecimentos)) < 5:
+        return None
+    divisor = GroupShuffleSplit(n_splits=1, test_size=proporcao_teste, random_state=42)
+    idx_treino, idx_teste = next(divisor.split(estabelecimentos, categorias, groups=estabelecimentos))
+    if len({categorias[i] for i in idx_treino}) < 2 or not len(idx_teste):
+        return None
+    pipeline = criar_pipeline()
+    pipeline.fit([estabelecimentos[i] for i in idx_treino], [categorias[i] for i in idx_treino])
+    return pipeline.score([estabelecimentos[i] for i in idx_teste], [categorias[i] for i in idx_teste])
+
+
+class ModeloCategoria:
+    """
+    Classificador local (TF-IDF de n-gramas de caracteres + regressão logística)
+    que prevê a categoria a partir do nome do estabelecimento, treinado com o histórico de transações.
+    """
+
+    def __init__(self, transactions, caminho: str = caminho_modelo):
+        self.transactions = transactions
+        self.caminho = caminho
+        self.artefato = None
+        self._carregado = False
+        self._novas_transacoes = 0
+        self._lock = threading.Lock()
+        self._lock_treino = threading.Lock()
+
+    def _carregar(self):
+        if os.path.exists(self.caminho):
+            try:
+                self.artefato = joblib.load(self.caminho)
+                print(f"Modelo de categorias carregado: {self.caminho} (acurácia holdout: {self.artefato['acuracia']})")
+            except Exception as e:
+                # Arquivo corrompido ou de outra versão do sklearn: segue sem modelo e retreina
+                print(f"Falha ao carregar modelo de categorias, iniciando retreino: {e}")
+                self.artefato = None
+                self.retreinar_em_background()
+        else:
+            print("Modelo de categorias ainda não treinado, iniciando treino em background")
+            self.retreinar_em_background()
+        self._carregado = True
+
+    def treinar(self) -> dict | None:
+        """Treina com todo o histórico, salva em disco e retorna o artefato (ou None se não houver dados suficientes)."""
+        estabelecimentos, categorias = carregar_historico(self.transactions)
+        if len(set(categorias)) < 2:
+            print("Histórico insuficiente para treinar o modelo de categorias")
+            return None
+
+        acuracia = avaliar_holdout(estabelecimentos, categorias)
+        pipeline = criar_pipeline()
+        pipeline.fit(estabelecimentos, categorias)
+        artefato = {
+            "pipeline": pipeline,
+            "acuracia": acuracia,
+            "amostras": len(estabelecimentos),
+            "treinado_em": datetime.now()
+        }
+
+        os.makedirs(os.path.dirname(self.caminho) or ".", exist_ok=True)
+        # Grava em arquivo temporário e troca atomicamente para nunca expor um arquivo pela metade
+        caminho_tmp = f"{self.caminho}.tmp"
+        joblib.dump(artefato, caminho_tmp)
+        os.replace(caminho_tmp, self.caminho)
+        with self._lock:
+            self.artefato = artefato
+        print(f"Modelo de categorias treinado com {len(estabelecimentos)} transações. Acurácia holdout: {acuracia}")
+        return artefato
+
+    def _treinar_seguro(self):
+        if not self._lock_treino.acquire(blocking=False):
+            return
+        try:
+            self.treinar()
+        except Exception as e:
+            print(f"Falha ao treinar modelo de categorias: {e}")
+        finally:
+            self._lock_treino.release()
+
+    def retreinar_em_background(self):
+        threading.Thread(target=self._treinar_seguro, daemon=True).start()
+
+    def registrar_transacao(self):
+        """Conta novas transações e dispara o retreino em background a cada `retreino_a_cada`."""
+        with self._lock:
+            self._novas_transacoes += 1
+            if self._novas_transacoes < retreino_a_cada:
+                return
+            self._novas_transacoes = 0
+        self.retreinar_em_background()
+
+    def prever(self, estabelecimento: str) -> tuple[str, float] | None:
+        """
+        Retorna (categoria, confiança) ou None se o modelo não estiver disponível ou falhar;
+        nesse caso quem chama segue para o LLM.
+        """
+        try:
+            with self._lock:
+                if not self._carregado:
+                    self._carregar()
+                artefato = self.artefato
+            if not artefato:
+                return None
+            probabilidades = artefato["pipeline"].predict_proba([estabelecimento.lower()])[0]
+            melhor = probabilidades.argmax()
+            return artefato["pipeline"].classes_[melhor], float(probabilidades[melhor])
+        except Exception as e:
+            print(f"Falha ao prever categoria com o modelo local: {e}")
+            return None
+
+
+if __name__ == "__main__":
+    # Treino manual e relatório de acurácia: python modelo_categoria.py
+    from dotenv import load_dotenv
+    load_dotenv()
+    from core import modelo_categoria
+    artefato = modelo_categoria.treinar()
+    if artefato:
+        print(f"Amostras: {artefato['amostras']} | Acurácia holdout: {artefato['acuracia']}")
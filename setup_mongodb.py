@@ -3,6 +3,8 @@ import os
 from dotenv import load_dotenv
 
 load_dotenv()
+from core import backfill_estabelecimento_chave, backfill_nome_chave_categorias
+
 client = MongoClient(os.environ["MONGO_URI"])
 db = client["financebot"]
 
@@ -13,6 +15,7 @@ transactions = db["transactions"]
 transactions.create_index("message_id", unique=True)
 transactions.create_index("estabelecimento")
 transactions.create_index("categoria")
+transactions.create_index([("estabelecimento_chave", 1), ("data", -1)])
 
 # Índices compostos: data sempre primeiro
 transactions.create_index([("data", 1), ("categoria", 1)])
@@ -24,6 +27,27 @@ errors.create_index("tipo")
 
 #Collection categories
 categories = db["categories"]
+
 categories.create_index("nome")
 
-print("Índices criados com sucesso!")
\ No newline at end of file
+# Chave normalizada do nome (sem acentos/maiúsculas), única: unifica categorias equivalentes duplicadas.
+# A mais antiga é mantida e as transações das demais passam a apontar para o nome dela.
+backfill_nome_chave_categorias()
+for duplicada in categories.aggregate([
+    {"$sort": {"_id": 1}},
+    {"$group": {"_id": "$nome_chave", "ids": {"$push": "$_id"}, "nomes": {"$push": "$nome"}, "total": {"$sum": 1}}},
+    {"$match": {"total": {"$gt": 1}}}
+]):
+    nome_mantido = duplicada["nomes"][0]
+    nomes_removidos = [nome for nome in duplicada["nomes"][1:] if nome != nome_mantido]
+    if nomes_removidos:
+        transactions.update_many({"categoria": {"$in": nomes_removidos}}, {"$set": {"categoria": nome_mantido}})
+    categories.delete_many({"_id": {"$in": duplicada["ids"][1:]}})
+    print(f"Categorias {nomes_removidos or [nome_mantido]} unificadas em '{nome_mantido}'")
+categories.create_index("nome_chave", unique=True)
+
+print("Índices criados com sucesso!")
+
+# Backfill único da chave canônica de estabelecimento nas transações antigas
+atualizadas = backfill_estabelecimento_chave()
+print(f"Chave de estabelecimento preenchida em {atualizadas} transações.")
\ No newline at end of file
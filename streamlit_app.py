@@ -1,5 +1,6 @@
 import streamlit as st
-import time, uuid
+import time, uuid, json
+from collections import deque
 
 #Load .env
 from dotenv import load_dotenv
@@ -8,6 +9,7 @@ load_dotenv(override=True)
 # Import functions
 from features import (
     agente_consulta_dados,
+    agente_consulta_dados_lote,
     rotear_intencao_usuario,
     processar_nova_transacao,
     registrar_erro_mongo,
@@ -40,20 +42,35 @@ st.set_page_config(page_title="Assistente Financeiro", page_icon="💸", layout=
 st.title("💸 Controle financeiro inteligente")
 st.caption("Converse sobre finanças. Adicione despesas, consulte dados ou relate problemas.")
 
-# Inicia sessão para histórico
-if "historico" not in st.session_state:
-    st.session_state.historico = []  # Lista de (autor, mensagem)
-    print("Histórico de conversa iniciado.")
+max_mensagens = 10
+# Turnos que o fragmento do chat pode acumular antes de um redesenho completo da página (2 trocas)
+folga_fragmento = 4
+
+def compactar_resposta(resposta):
+    """Normaliza a resposta do agente e guarda o gráfico como JSON compacto (bem menor que o dict Plotly)."""
+    if isinstance(resposta, str):
+        resposta = {"mensagem": resposta, "grafico": None}
+    grafico = resposta.get("grafico")
+    if grafico and not isinstance(grafico, str):
+        grafico = json.dumps(grafico, separators=(",", ":"), ensure_ascii=False)
+    return {"mensagem": resposta.get("mensagem"), "grafico": grafico}
 
-# Input de mensagem
-with st.form(key="form_chat", clear_on_submit=True):
-    user_message = st.text_input("Digite sua mensagem...", max_chars=400)
-    enviar = st.form_submit_button("Enviar")
+def adicionar_ao_historico(autor, conteudo):
+    st.session_state.ultimo_turno += 1
+    st.session_state.historico.append((st.session_state.ultimo_turno, autor, conteudo))
+
+def renderizar_turno(turno):
+    turno_id, autor, conteudo = turno
+    if autor == "usuário":
+        mensagem_usuario(conteudo["mensagem"])
+    else:
+        mensagem_agente(conteudo["mensagem"])
+        if conteudo.get("grafico"):
+            st.plotly_chart(json.loads(conteudo["grafico"]), use_container_width=True, key=f"grafico_{turno_id}")
 
-# Processamento ao enviar mensagem
-if enviar and user_message.strip():
+def processar_mensagem(user_message):
     print(f"[Usuário] {user_message}")
-    st.session_state.historico.append(("usuário", user_message))
+    adicionar_ao_historico("usuário", {"mensagem": user_message, "grafico": None})
 
     try:
         # --- Integração com suas funções ---
@@ -66,6 +83,11 @@ if enviar and user_message.strip():
             resposta = agente_consulta_dados(user_message)
             print(f"[Agente - consulta]: {resposta}")
 
+        elif feature == "analise_lote":
+            print("Chamando agente_consulta_dados_lote...")
+            resposta = agente_consulta_dados_lote(user_message)
+            print(f"[Agente - consulta em lote]: {resposta}")
+
         elif feature == "insercao":
             user = "usuario_streamlit"
             timestamp = int(time.time())
@@ -92,21 +114,43 @@ if enviar and user_message.strip():
         except Exception as er:
             print(f"Falha ao registrar erro: {er}")
             
-    st.session_state.historico.append(("agente", resposta))
+    adicionar_ao_historico("agente", compactar_resposta(resposta))
+
+# Inicia sessão para histórico (buffer circular: só as últimas mensagens ficam em memória)
+if "historico" not in st.session_state:
+    st.session_state.historico = deque(maxlen=max_mensagens)  # (turno, autor, conteudo)
+    st.session_state.ultimo_turno = 0
+    print("Histórico de conversa iniciado.")
+
+# Execução completa do app: desenha o histórico atual uma única vez, deixando espaço para os
+# turnos que o fragmento vai acrescentar sem passar de `max_mensagens` na tela
+for turno in list(st.session_state.historico)[-(max_mensagens - folga_fragmento):]:
+    renderizar_turno(turno)
+st.session_state.renderizado_ate = st.session_state.ultimo_turno
+
+@st.fragment
+def chat():
+    # Ao enviar uma mensagem só este fragmento é reexecutado: ele redesenha os turnos criados desde
+    # o último redesenho completo (no máximo `folga_fragmento`), não o histórico inteiro
+    novos_turnos = st.container()
+
+    with st.form(key="form_chat", clear_on_submit=True):
+        user_message = st.text_input("Digite sua mensagem...", max_chars=400)
+        enviar = st.form_submit_button("Enviar")
+
+    if enviar and user_message.strip():
+        processar_mensagem(user_message)
+
+    novos = [t for t in st.session_state.historico if t[0] > st.session_state.renderizado_ate]
+    if len(novos) > folga_fragmento:
+        # Fragmento cheio: redesenho completo move os turnos para o histórico estático e descarta os antigos
+        st.rerun()
+    with novos_turnos:
+        for turno in novos:
+            renderizar_turno(turno)
+
+chat()
 
-# Mostra histórico (tudo invertido para chat ficar do mais antigo pro mais novo)
-max_mensagens = 10
-historico_limitado = st.session_state.historico[-max_mensagens:]
-for idx, (autor, conteudo) in enumerate(historico_limitado):
-    if isinstance(conteudo, str):
-        conteudo = {"mensagem": conteudo, "grafico": None}
-    if autor == "usuário":
-        mensagem_usuario(conteudo["mensagem"])
-    else:
-        mensagem_agente(conteudo["mensagem"])
-        if conteudo.get("grafico"):
-            st.plotly_chart(conteudo["grafico"], use_container_width=True, key=f"grafico_{idx}")
-            
 # Rodapé
 st.markdown("<hr>", unsafe_allow_html=True)
 st.caption("Desenvolvido por Felipe Saul Zebulun • Assistente Financeiro 2025")